@@ -1,17 +1,71 @@
 import os
-import csv
-import io
+import math
+import itertools
 from datetime import date, datetime, timedelta
-from typing import Optional, Literal
+from typing import Iterable, List, Optional, Literal, Tuple
 
-from fastapi import FastAPI, Header, HTTPException, Response
+from cachetools import TTLCache
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 
-from db import pool, open_pool
+from db import pool, open_pool, close_pool
 
 API_SECRET = os.getenv("API_SECRET", "")  # optional (same in bot & app)
+BULK_COPY_THRESHOLD = 1000  # rows; above this COPY beats a pipelined executemany
+BULK_MAX_ROWS = 10_000  # rows per /transactions/bulk call
+LANGS_MAX_IDS = 1000  # ids per /users/langs call
+STATS_TTL = 30  # seconds; the mini app polls stats far more often than users write
+STATS_CACHE_SIZE = 10_000  # cached stats payloads, across all users
 
-app = FastAPI(title="Hamyon API")
+# Column order of tx_params(); every transactions write path is built from it.
+TX_COLUMNS = ("telegram_id", "type", "amount", "category_key", "description", "merchant", "tx_date", "source")
+
+TX_INSERT_MANY_SQL = """
+insert into transactions
+({columns})
+values ({placeholders})
+""".format(columns=", ".join(TX_COLUMNS), placeholders=",".join(["%s"] * len(TX_COLUMNS)))
+
+TX_INSERT_SQL = TX_INSERT_MANY_SQL + "returning id\n"
+
+TX_COPY_SQL = "copy transactions ({columns}) from stdin".format(columns=", ".join(TX_COLUMNS))
+
+# First write from a user this process hasn't seen: the users upsert rides
+# along in the same statement (and commit).
+TX_INSERT_WITH_USER_SQL = """
+with new_user as (
+  insert into users (telegram_id) values (%s)
+  on conflict (telegram_id) do nothing
+)
+""" + TX_INSERT_SQL
+
+# telegram_ids known to have a users row; skips the upsert on later writes.
+# Bounded, and entries expire so a deleted users row is recreated by the
+# upsert within KNOWN_USERS_TTL.
+KNOWN_USERS_SIZE = 100_000
+KNOWN_USERS_TTL = 3600  # seconds
+_known_users: "TTLCache[int, bool]" = TTLCache(maxsize=KNOWN_USERS_SIZE, ttl=KNOWN_USERS_TTL)
+
+def mark_known(telegram_ids: Iterable[int]):
+    for telegram_id in telegram_ids:
+        _known_users[telegram_id] = True
+
+# (telegram_id, write generation, route, bucket) -> payload
+_stats_cache: "TTLCache[Tuple[int, int, str, str], dict]" = TTLCache(maxsize=STATS_CACHE_SIZE, ttl=STATS_TTL)
+
+# telegram_id -> write generation. A write moves it to a fresh value, which
+# orphans every cached payload of that user, including one a read still in
+# flight (keyed by the generation it started with) stores afterwards.
+# Generations are never reused, and entries outlive STATS_TTL, so falling
+# back to 0 after expiry can't resurrect a payload cached before a write.
+# Bounded by TTL only: a size eviction could drop a user's generation while
+# a pre-write payload is still live. It holds the users who wrote in the
+# last 2 * STATS_TTL, no more.
+_write_gen: "TTLCache[int, int]" = TTLCache(maxsize=math.inf, ttl=2 * STATS_TTL)
+_gen_seq = itertools.count(1)
+
+app = FastAPI(title="Hamyon API", default_response_class=ORJSONResponse)
 
 class TxIn(BaseModel):
     telegram_id: int
@@ -27,135 +81,228 @@ class LangIn(BaseModel):
     telegram_id: int
     language: Literal["uz","ru","en"]
 
+class LangsIn(BaseModel):
+    telegram_ids: List[int]
+
 def require_secret(x_api_secret: Optional[str]):
     if API_SECRET and x_api_secret != API_SECRET:
         raise HTTPException(status_code=401, detail="Invalid API secret")
 
+def tx_params(p: TxIn) -> tuple:
+    # tx_date is NOT NULL; an explicit NULL would bypass the column default.
+    tx_date = p.tx_date or date.today()
+    return (p.telegram_id, p.type, p.amount, p.category_key, p.description, p.merchant, tx_date, p.source)
+
+def cache_key(telegram_id: int, route: str, bucket: str) -> Tuple[int, int, str, str]:
+    return (telegram_id, _write_gen.get(telegram_id, 0), route, bucket)
+
+def cache_get(key: Tuple[int, int, str, str]) -> Optional[dict]:
+    return _stats_cache.get(key)
+
+def cache_put(key: Tuple[int, int, str, str], payload: dict) -> dict:
+    _stats_cache[key] = payload
+    return payload
+
+def cache_invalidate(telegram_id: int):
+    _write_gen[telegram_id] = next(_gen_seq)
+
 @app.on_event("startup")
 async def startup():
     await open_pool()
 
+@app.on_event("shutdown")
+async def shutdown():
+    await close_pool()
+
 @app.get("/health")
 async def health():
     return {"ok": True}
 
+@app.get("/metrics")
+async def metrics(x_api_secret: Optional[str] = Header(default=None, alias="X-API-SECRET")):
+    # Pool internals are never public: without a secret the route doesn't exist.
+    if not API_SECRET:
+        raise HTTPException(status_code=404, detail="Not Found")
+    require_secret(x_api_secret)
+    return {"pool": pool.get_stats()}
+
 @app.post("/users/lang")
 async def set_lang(payload: LangIn, x_api_secret: Optional[str] = Header(default=None, alias="X-API-SECRET")):
     require_secret(x_api_secret)
     async with pool.connection() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute(
-                """
-                insert into users (telegram_id, language)
-                values (%s, %s)
-                on conflict (telegram_id)
-                do update set language = excluded.language
-                """,
-                (payload.telegram_id, payload.language),
-            )
+        await conn.execute(
+            """
+            insert into users (telegram_id, language)
+            values (%s, %s)
+            on conflict (telegram_id)
+            do update set language = excluded.language
+            """,
+            (payload.telegram_id, payload.language),
+            prepare=True,
+        )
+    mark_known((payload.telegram_id,))
     return {"ok": True, "language": payload.language}
 
+# Single-user lookup, kept for the mini app; the bot batches via /users/langs
 @app.get("/users/lang")
 async def get_lang(telegram_id: int, x_api_secret: Optional[str] = Header(default=None, alias="X-API-SECRET")):
     require_secret(x_api_secret)
     async with pool.connection() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute("select language from users where telegram_id=%s", (telegram_id,))
-            row = await cur.fetchone()
+        cur = await conn.execute("select language from users where telegram_id=%s", (telegram_id,), prepare=True)
+        row = await cur.fetchone()
+    if row:
+        mark_known((telegram_id,))
     return {"language": (row[0] if row else "uz")}
 
+# A POST so a full batch of ids fits in the body, not the request line
+@app.post("/users/langs")
+async def get_langs(payload: LangsIn, x_api_secret: Optional[str] = Header(default=None, alias="X-API-SECRET")):
+    """Languages for several users at once; users without a row are omitted"""
+    require_secret(x_api_secret)
+    if len(payload.telegram_ids) > LANGS_MAX_IDS:
+        raise HTTPException(status_code=413, detail=f"At most {LANGS_MAX_IDS} ids per request")
+    async with pool.connection() as conn:
+        cur = await conn.execute(
+            "select telegram_id, language from users where telegram_id = any(%s)",
+            (payload.telegram_ids,),
+            prepare=True,
+        )
+        rows = await cur.fetchall()
+    mark_known(tid for tid, _ in rows)
+    return {"languages": {str(tid): lang for tid, lang in rows}}
+
 @app.post("/transactions")
 async def create_tx(payload: TxIn, x_api_secret: Optional[str] = Header(default=None, alias="X-API-SECRET")):
     require_secret(x_api_secret)
     async with pool.connection() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute(
-                """
-                insert into transactions
-                (telegram_id, type, amount, category_key, description, merchant, tx_date, source)
-                values (%s,%s,%s,%s,%s,%s,%s,%s)
-                returning id
-                """,
-                (
-                    payload.telegram_id,
-                    payload.type,
-                    payload.amount,
-                    payload.category_key,
-                    payload.description,
-                    payload.merchant,
-                    payload.tx_date,
-                    payload.source,
-                ),
+        if payload.telegram_id in _known_users:
+            cur = await conn.execute(TX_INSERT_SQL, tx_params(payload), prepare=True)
+        else:
+            cur = await conn.execute(
+                TX_INSERT_WITH_USER_SQL,
+                (payload.telegram_id, *tx_params(payload)),
+                prepare=True,
             )
-            row = await cur.fetchone()
-    return {"ok": True, "id": str(row[0])}
+        row = await cur.fetchone()
+    mark_known((payload.telegram_id,))
+    cache_invalidate(payload.telegram_id)
+    return {"ok": True, "id": row[0]}
+
+@app.post("/transactions/bulk")
+async def create_tx_bulk(payload: List[TxIn], x_api_secret: Optional[str] = Header(default=None, alias="X-API-SECRET")):
+    require_secret(x_api_secret)
+    if len(payload) > BULK_MAX_ROWS:
+        raise HTTPException(status_code=413, detail=f"At most {BULK_MAX_ROWS} transactions per request")
+    rows = [tx_params(p) for p in payload]
+    if not rows:
+        return {"ok": True, "count": 0}
+    telegram_ids = sorted({p.telegram_id for p in payload})
+    new_ids = [tid for tid in telegram_ids if tid not in _known_users]
+    async with pool.connection() as conn:
+        async with conn.transaction():
+            async with conn.cursor() as cur:
+                if new_ids:
+                    await cur.execute(
+                        """
+                        insert into users (telegram_id)
+                        select unnest(%s::bigint[])
+                        on conflict (telegram_id) do nothing
+                        """,
+                        (new_ids,),
+                    )
+                if len(rows) > BULK_COPY_THRESHOLD:
+                    async with cur.copy(TX_COPY_SQL) as copy:
+                        for r in rows:
+                            await copy.write_row(r)
+                else:
+                    await cur.executemany(TX_INSERT_MANY_SQL, rows)
+    mark_known(new_ids)
+    for telegram_id in telegram_ids:
+        cache_invalidate(telegram_id)
+    return {"ok": True, "count": len(rows)}
 
 @app.get("/stats/today")
 async def stats_today(telegram_id: int, x_api_secret: Optional[str] = Header(default=None, alias="X-API-SECRET")):
     require_secret(x_api_secret)
     today = date.today()
+    key = cache_key(telegram_id, "today", str(today))
+    cached = cache_get(key)
+    if cached is not None:
+        return cached
     async with pool.connection() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute(
-                """
-                select
-                  coalesce(sum(case when type='expense' then amount end),0) as expense,
-                  coalesce(sum(case when type='income' then amount end),0) as income,
-                  coalesce(sum(case when type='debt' then amount end),0) as debt,
-                  count(*) as count
-                from transactions
-                where telegram_id=%s
-                  and coalesce(tx_date, created_at::date) = %s
-                """,
-                (telegram_id, today),
-            )
-            row = await cur.fetchone()
-    return {"expense": row[0], "income": row[1], "debt": row[2], "count": row[3]}
+        cur = await conn.execute(
+            """
+            select
+              coalesce(sum(case when type='expense' then total end),0)::bigint as expense,
+              coalesce(sum(case when type='income' then total end),0)::bigint as income,
+              coalesce(sum(case when type='debt' then total end),0)::bigint as debt,
+              coalesce(sum(cnt),0)::bigint as count
+            from tx_daily
+            where telegram_id=%s
+              and day = %s
+            """,
+            (telegram_id, today),
+            prepare=True,
+        )
+        row = await cur.fetchone()
+    return cache_put(key, {"expense": row[0], "income": row[1], "debt": row[2], "count": row[3]})
 
 @app.get("/stats/range")
 async def stats_range(telegram_id: int, days: int = 7, x_api_secret: Optional[str] = Header(default=None, alias="X-API-SECRET")):
     require_secret(x_api_secret)
     since = date.today() - timedelta(days=days-1)
+    key = cache_key(telegram_id, "range", str(since))
+    cached = cache_get(key)
+    if cached is not None:
+        return cached
     async with pool.connection() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute(
-                """
-                select
-                  coalesce(sum(case when type='expense' then amount end),0) as expense,
-                  coalesce(sum(case when type='income' then amount end),0) as income,
-                  coalesce(sum(case when type='debt' then amount end),0) as debt,
-                  count(*) as count
-                from transactions
-                where telegram_id=%s
-                  and coalesce(tx_date, created_at::date) >= %s
-                """,
-                (telegram_id, since),
-            )
-            row = await cur.fetchone()
-    return {"expense": row[0], "income": row[1], "debt": row[2], "count": row[3], "since": str(since)}
+        cur = await conn.execute(
+            """
+            select
+              coalesce(sum(case when type='expense' then total end),0)::bigint as expense,
+              coalesce(sum(case when type='income' then total end),0)::bigint as income,
+              coalesce(sum(case when type='debt' then total end),0)::bigint as debt,
+              coalesce(sum(cnt),0)::bigint as count
+            from tx_daily
+            where telegram_id=%s
+              and day >= %s
+            """,
+            (telegram_id, since),
+            prepare=True,
+        )
+        row = await cur.fetchone()
+    return cache_put(
+        key,
+        {"expense": row[0], "income": row[1], "debt": row[2], "count": row[3], "since": since},
+    )
 
 @app.get("/export/csv")
 async def export_csv(telegram_id: int, x_api_secret: Optional[str] = Header(default=None, alias="X-API-SECRET")):
     require_secret(x_api_secret)
-    async with pool.connection() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute(
-                """
-                select created_at, type, amount, category_key, description, merchant, coalesce(tx_date, created_at::date) as day, source
-                from transactions
-                where telegram_id=%s
-                order by created_at desc
-                limit 2000
-                """,
-                (telegram_id,),
-            )
-            rows = await cur.fetchall()
 
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["created_at","type","amount","category","description","merchant","date","source"])
-    for r in rows:
-        writer.writerow(list(r))
+    async def rows_csv():
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                # Postgres renders the CSV itself; we only relay the bytes.
+                # Dates are pinned to what str(datetime)/str(date) produced
+                # before, independent of the session's DateStyle.
+                async with cur.copy(
+                    """
+                    copy (
+                      select to_char(created_at, case when created_at = date_trunc('second', created_at)
+                                                      then 'YYYY-MM-DD HH24:MI:SSTZH:TZM'
+                                                      else 'YYYY-MM-DD HH24:MI:SS.USTZH:TZM' end) as created_at,
+                             type, amount, category_key as category, description, merchant,
+                             to_char(tx_date, 'YYYY-MM-DD') as "date", source
+                      from transactions
+                      where telegram_id=%s
+                      order by created_at desc
+                      limit 2000
+                    ) to stdout with (format csv, header)
+                    """,
+                    (telegram_id,),
+                ) as copy:
+                    async for chunk in copy:
+                        yield bytes(chunk)
 
-    content = output.getvalue().encode("utf-8")
-    return Response(content=content, media_type="text/csv")
+    return StreamingResponse(rows_csv(), media_type="text/csv")
@@ -11,15 +11,25 @@ Features:
 - Mini App integration
 """
 
+import io
 import os
 import json
-import uuid
+import time
+import queue
+import atexit
 import asyncio
+import itertools
+import logging
+import weakref
+from logging.handlers import QueueHandler, QueueListener
 from dataclasses import dataclass, field
-from datetime import datetime
-from typing import Optional, Dict, Tuple, List
+from functools import lru_cache, wraps
+from typing import BinaryIO, Optional, Dict, Tuple, List
 
 import httpx
+import orjson
+from cachetools import TTLCache
+from openai import AsyncOpenAI
 from telegram import (
     Update,
     InlineKeyboardButton,
@@ -29,32 +39,63 @@ from telegram import (
     WebAppInfo,
 )
 from telegram.ext import (
+    AIORateLimiter,
     Application,
+    ApplicationHandlerStop,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
     ContextTypes,
     filters,
 )
 from telegram.constants import ParseMode
 
-from nlp import parse_one, parse_multi, normalize_category
+from nlp import NON_DIGIT_RE, parse_one, parse_multi
 
 # ══════════════════════════════════════════════════════════════════════════════
 # CONFIGURATION
 # ══════════════════════════════════════════════════════════════════════════════
 
+def _env_int(name: str, default: int, lo: int, hi: int) -> int:
+    """Integer env var clamped to [lo, hi]; unset or unparsable gives the default"""
+    try:
+        value = int(os.getenv(name, ""))
+    except ValueError:
+        return default
+    return max(lo, min(hi, value))
+
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 API_URL = os.getenv("API_URL") or os.getenv("PUBLIC_URL") or os.getenv("BACKEND_URL")
 API_SECRET = os.getenv("API_SECRET", "")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 WEBAPP_URL = os.getenv("WEBAPP_URL", "")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # public base URL; empty = long polling
+WEBHOOK_PORT = _env_int("WEBHOOK_PORT", 8443, 1, 65535)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None  # checked against Telegram's secret-token header
 
 if not TOKEN:
     raise ValueError("❌ TELEGRAM_BOT_TOKEN not set")
 if not API_URL:
     raise ValueError("❌ API_URL not set")
 
+LOG = logging.getLogger("hamyon")
+
+def setup_logging():
+    """Log through a queue: callers only enqueue, a listener thread writes"""
+    records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = QueueListener(records, stream)
+    
+    root = logging.getLogger()
+    root.addHandler(QueueHandler(records))
+    root.setLevel(logging.INFO)
+    logging.getLogger("httpx").setLevel(logging.WARNING)  # one INFO line per request otherwise
+    
+    listener.start()
+    atexit.register(listener.stop)
+
 # ══════════════════════════════════════════════════════════════════════════════
 # TRANSLATIONS - Clean & Professional
 # ══════════════════════════════════════════════════════════════════════════════
@@ -431,10 +472,20 @@ I18N = {
     },
 }
 
+# (lang, key) -> text, with keys a language lacks filled in from "uz"
+_I18N_FLAT = {
+    (lang, key): text
+    for lang, texts in I18N.items()
+    for key, text in {**I18N["uz"], **texts}.items()
+}
+_I18N_FALLBACK = I18N["uz"]
+
 def t(lang: str, key: str) -> str:
     """Get translated text"""
-    lang = lang if lang in I18N else "uz"
-    return I18N[lang].get(key, I18N["uz"].get(key, key))
+    text = _I18N_FLAT.get((lang, key))
+    if text is None:
+        return _I18N_FALLBACK.get(key, key)
+    return text
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -466,7 +517,7 @@ def get_category_name(lang: str, cat_key: str) -> str:
 # DRAFT STATE
 # ══════════════════════════════════════════════════════════════════════════════
 
-@dataclass
+@dataclass(slots=True)
 class Draft:
     tx_type: str = "expense"
     category_key: str = "other"
@@ -474,68 +525,181 @@ class Draft:
     description: Optional[str] = None
     source: str = "text"
 
-DRAFTS: Dict[Tuple[int, str], Draft] = {}
-EDIT_MODE: Dict[int, Tuple[str, str]] = {}
-USER_STATE: Dict[int, str] = {}
+# Abandoned drafts and half-finished edits are never cleaned up explicitly,
+# so per-user state is size-capped and expires. Entries can vanish between
+# two accesses: use get()/pop(), not `in` followed by [].
+STATE_MAXSIZE = 50_000
+STATE_TTL = 1800  # seconds
+PROMPT_TTL = 300  # seconds; a pending "type the amount" prompt goes stale fast
+
+DRAFTS: "TTLCache[Tuple[int, str], Draft]" = TTLCache(maxsize=STATE_MAXSIZE, ttl=STATE_TTL)
+EDIT_MODE: "TTLCache[int, Tuple[str, str]]" = TTLCache(maxsize=STATE_MAXSIZE, ttl=PROMPT_TTL)
+USER_STATE: "TTLCache[int, str]" = TTLCache(maxsize=STATE_MAXSIZE, ttl=PROMPT_TTL)
+
+# Draft ids only need to be unique per user. Seeding the counter from the
+# clock (ms) keeps ids from an earlier run out of reach of a restarted
+# process, so a stale keyboard can't act on a new draft.
+_DRAFT_IDS = itertools.count(time.time_ns() // 1_000_000)
+
+def new_draft_id() -> str:
+    return format(next(_DRAFT_IDS), "x")
+
+# The user's language is cached in PTB's context.user_data as
+# "lang"/"lang_expires", saving an API round-trip on every update
+LANG_TTL = 60  # seconds; the mini app can change the language behind our back
+LANG_BATCH_MAX = 1000  # ids per POST /users/langs; matches the API's cap
 
 
 # ══════════════════════════════════════════════════════════════════════════════
 # API HELPERS
 # ══════════════════════════════════════════════════════════════════════════════
 
+API_HEADERS = {}
+if API_SECRET:
+    API_HEADERS["X-API-KEY"] = API_SECRET
+    API_HEADERS["X-API-SECRET"] = API_SECRET  # Support both headers
+
+# One pooled client for the whole process: keep-alive (HTTP/2 where the
+# API offers it) instead of a fresh TCP+TLS handshake per call. Base URL
+# and auth headers are bound once here.
+HTTP = httpx.AsyncClient(
+    base_url=API_URL,
+    headers=API_HEADERS,
+    http2=True,
+    timeout=httpx.Timeout(30.0, connect=5.0),
+    limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=30),
+)
+
+# Request bodies are encoded with orjson rather than httpx's stdlib json
+JSON_HEADERS = {"Content-Type": "application/json"}
+
 async def api_post(path: str, json_body: dict) -> dict:
-    headers = {}
-    if API_SECRET:
-        headers["X-API-KEY"] = API_SECRET
-        headers["X-API-SECRET"] = API_SECRET  # Support both headers
-    
-    url = f"{API_URL}{path}"
-    print(f"📤 API POST: {url}")
-    print(f"📦 Body: {json_body}")
-    try:
-        async with httpx.AsyncClient(timeout=30) as client:
-            r = await client.post(url, json=json_body, headers=headers)
-            print(f"📥 Response: {r.status_code}")
-            if r.status_code != 200:
-                print(f"❌ Error body: {r.text}")
-            r.raise_for_status()
-            return r.json()
-    except httpx.ConnectError as e:
-        print(f"❌ Connection error: {e}")
-        raise
-    except Exception as e:
-        print(f"❌ API error: {e}")
-        raise
+    LOG.debug("API POST %s body=%s", path, json_body)
+    r = await HTTP.post(path, content=orjson.dumps(json_body), headers=JSON_HEADERS)
+    if r.status_code != 200:
+        LOG.warning("API POST %s -> %s: %s", path, r.status_code, r.text)
+    r.raise_for_status()
+    return orjson.loads(r.content)
 
-async def api_get(path: str, params: dict) -> Tuple[dict, httpx.Response]:
-    headers = {}
-    if API_SECRET:
-        headers["X-API-KEY"] = API_SECRET
-        headers["X-API-SECRET"] = API_SECRET  # Support both headers
+async def api_get(path: str, params: dict) -> dict:
+    r = await HTTP.get(path, params=params)
+    r.raise_for_status()
+    return orjson.loads(r.content)
+
+def api_write_not_applied(exc: Exception) -> bool:
+    """True if a failed API call provably wrote nothing
     
-    async with httpx.AsyncClient(timeout=30) as client:
-        r = await client.get(f"{API_URL}{path}", params=params, headers=headers)
+    Either the request never left the bot (connect or pool errors) or the
+    API rejected it (4xx). A read timeout or a 5xx may come after the API
+    already committed.
+    """
+    if isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return True
+    return isinstance(exc, httpx.HTTPStatusError) and 400 <= exc.response.status_code < 500
+
+async def api_stream(path: str, params: dict, out: BinaryIO) -> BinaryIO:
+    """Stream a non-JSON body (e.g. the CSV export) into a file object"""
+    async with HTTP.stream("GET", path, params=params) as r:
         r.raise_for_status()
-        return r.json(), r
+        async for chunk in r.aiter_bytes():
+            out.write(chunk)
+    out.seek(0)
+    return out
 
-async def get_user_lang(tg_id: int) -> str:
-    try:
-        data, _ = await api_get("/users/lang", {"telegram_id": tg_id})
-        return data.get("language", "uz")
-    except:
+async def close_http(app: Application):
+    await HTTP.aclose()
+
+class LangLoader:
+    """Batches language lookups started in the same event-loop tick
+    
+    A burst of updates from different users (one getUpdates batch) is
+    resolved with POST /users/langs calls of up to LANG_BATCH_MAX ids
+    instead of one call per user. Flushing on the next tick rather than on
+    a timer adds no latency. A lookup already in flight is shared, so
+    concurrent updates from one user never fetch twice. Futures resolve to
+    None if the lookup fails.
+    """
+    
+    def __init__(self):
+        self._pending: Dict[int, "asyncio.Future[Optional[str]]"] = {}
+        self._inflight: Dict[int, "asyncio.Future[Optional[str]]"] = {}
+        self._flushes: set = set()
+    
+    def load(self, tg_id: int) -> "asyncio.Future[Optional[str]]":
+        fut = self._inflight.get(tg_id) or self._pending.get(tg_id)
+        if fut is None:
+            loop = asyncio.get_running_loop()
+            if not self._pending:
+                loop.call_soon(self._schedule_flush)
+            fut = self._pending[tg_id] = loop.create_future()
+        return fut
+    
+    def _schedule_flush(self):
+        task = asyncio.ensure_future(self._flush())
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+    
+    async def _flush(self):
+        batch, self._pending = self._pending, {}
+        self._inflight.update(batch)
+        ids = list(batch)
+        try:
+            await asyncio.gather(*(
+                self._fetch(ids[i:i + LANG_BATCH_MAX], batch)
+                for i in range(0, len(ids), LANG_BATCH_MAX)
+            ))
+        finally:
+            for tg_id, fut in batch.items():
+                if self._inflight.get(tg_id) is fut:
+                    del self._inflight[tg_id]
+    
+    async def _fetch(self, ids: List[int], batch: Dict[int, "asyncio.Future[Optional[str]]"]):
+        try:
+            data = await api_post("/users/langs", {"telegram_ids": ids})
+            langs = data.get("languages", {})
+        except Exception:
+            LOG.exception("Language lookup failed for %d users", len(ids))
+            langs = None
+        for tg_id in ids:
+            fut = batch[tg_id]
+            if not fut.done():
+                fut.set_result(None if langs is None else langs.get(str(tg_id), "uz"))
+
+LANG_LOADER = LangLoader()
+
+async def fetch_user_lang(tg_id: int) -> Optional[str]:
+    # Shielded: one cancelled handler must not cancel the future it shares
+    return await asyncio.shield(LANG_LOADER.load(tg_id))
+
+async def get_user_lang(tg_id: int, context: ContextTypes.DEFAULT_TYPE) -> str:
+    user_data = context.user_data
+    if user_data.get("lang_expires", 0) > time.time():
+        return user_data["lang"]
+    
+    lang = await fetch_user_lang(tg_id)
+    if lang is None:
         return "uz"
+    user_data["lang"] = lang
+    user_data["lang_expires"] = time.time() + LANG_TTL
+    return lang
 
-async def set_user_lang(tg_id: int, lang: str):
+async def set_user_lang(tg_id: int, lang: str, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data["lang"] = lang
+    context.user_data["lang_expires"] = time.time() + LANG_TTL
     try:
         await api_post("/users/lang", {"telegram_id": tg_id, "language": lang})
-    except:
-        pass
+    except Exception:
+        LOG.exception("Language save failed tg_id=%s", tg_id)
 
 
 # ══════════════════════════════════════════════════════════════════════════════
 # KEYBOARDS - Clean & Professional
 # ══════════════════════════════════════════════════════════════════════════════
 
+# Keyboards that depend only on the language are built once per language and
+# shared; PTB's Telegram objects are immutable, so reuse is safe.
+
+@lru_cache(maxsize=None)
 def kb_main_menu(lang: str) -> ReplyKeyboardMarkup:
     """Main reply keyboard - clean 2x3 grid"""
     return ReplyKeyboardMarkup(
@@ -547,6 +711,7 @@ def kb_main_menu(lang: str) -> ReplyKeyboardMarkup:
         input_field_placeholder=t(lang, "btn_add") + "..."
     )
 
+@lru_cache(maxsize=None)
 def kb_language() -> InlineKeyboardMarkup:
     """Language selection"""
     return InlineKeyboardMarkup([
@@ -559,6 +724,7 @@ def kb_language() -> InlineKeyboardMarkup:
         ],
     ])
 
+@lru_cache(maxsize=None)
 def kb_quick_add(lang: str) -> InlineKeyboardMarkup:
     """Quick add type selection"""
     return InlineKeyboardMarkup([
@@ -567,6 +733,7 @@ def kb_quick_add(lang: str) -> InlineKeyboardMarkup:
         [InlineKeyboardButton(t(lang, "quick_debt"), callback_data="quickadd:debt")],
     ])
 
+@lru_cache(maxsize=None)
 def kb_stats(lang: str) -> InlineKeyboardMarkup:
     """Statistics period selection"""
     return InlineKeyboardMarkup([
@@ -580,6 +747,7 @@ def kb_stats(lang: str) -> InlineKeyboardMarkup:
         ],
     ])
 
+@lru_cache(maxsize=None)
 def kb_settings(lang: str) -> InlineKeyboardMarkup:
     """Settings menu"""
     return InlineKeyboardMarkup([
@@ -587,59 +755,63 @@ def kb_settings(lang: str) -> InlineKeyboardMarkup:
         [InlineKeyboardButton(t(lang, "btn_help"), callback_data="settings:help")],
     ])
 
-def kb_draft_confirm(lang: str, draft_id: str) -> InlineKeyboardMarkup:
-    """Draft confirmation - clean layout"""
+# Draft keyboards differ only in the draft id at the end of each callback, so
+# the (text, callback prefix) layout is cached and only the id is bound per call.
+
+def _bind_draft_kb(layout: tuple, draft_id: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton(t(lang, "btn_confirm"), callback_data=f"draft:save:{draft_id}"),
-            InlineKeyboardButton(t(lang, "btn_edit"), callback_data=f"draft:edit:{draft_id}"),
-        ],
-        [
-            InlineKeyboardButton(t(lang, "btn_cancel"), callback_data=f"draft:cancel:{draft_id}"),
-        ],
+        [InlineKeyboardButton(text, callback_data=prefix + draft_id) for text, prefix in row]
+        for row in layout
     ])
 
+@lru_cache(maxsize=None)
+def _draft_confirm_layout(lang: str) -> tuple:
+    return (
+        ((t(lang, "btn_confirm"), "draft:save:"), (t(lang, "btn_edit"), "draft:edit:")),
+        ((t(lang, "btn_cancel"), "draft:cancel:"),),
+    )
+
+@lru_cache(maxsize=None)
+def _draft_edit_layout(lang: str) -> tuple:
+    return (
+        ((t(lang, "edit_category"), "edit:cat:"), (t(lang, "edit_amount"), "edit:amt:")),
+        ((t(lang, "edit_desc"), "edit:desc:"), (t(lang, "edit_type"), "edit:type:")),
+        ((t(lang, "btn_back"), "draft:back:"),),
+    )
+
+@lru_cache(maxsize=None)
+def _categories_layout(lang: str, tx_type: str) -> tuple:
+    cats = CATEGORIES.get(tx_type, CATEGORIES["expense"])
+    buttons = [(f"{emoji} {key.capitalize()}", f"pickcat:{key}:") for key, emoji in cats]
+    rows = tuple(tuple(buttons[i:i + 2]) for i in range(0, len(buttons), 2))
+    return rows + (((t(lang, "btn_back"), "draft:edit:"),),)
+
+@lru_cache(maxsize=None)
+def _tx_type_layout(lang: str) -> tuple:
+    return (
+        ((t(lang, "type_expense"), "picktype:expense:"),),
+        ((t(lang, "type_income"), "picktype:income:"),),
+        ((t(lang, "type_debt"), "picktype:debt:"),),
+        ((t(lang, "btn_back"), "draft:edit:"),),
+    )
+
+def kb_draft_confirm(lang: str, draft_id: str) -> InlineKeyboardMarkup:
+    """Draft confirmation - clean layout"""
+    return _bind_draft_kb(_draft_confirm_layout(lang), draft_id)
+
 def kb_draft_edit(lang: str, draft_id: str) -> InlineKeyboardMarkup:
     """Edit menu - what to change"""
-    return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton(t(lang, "edit_category"), callback_data=f"edit:cat:{draft_id}"),
-            InlineKeyboardButton(t(lang, "edit_amount"), callback_data=f"edit:amt:{draft_id}"),
-        ],
-        [
-            InlineKeyboardButton(t(lang, "edit_desc"), callback_data=f"edit:desc:{draft_id}"),
-            InlineKeyboardButton(t(lang, "edit_type"), callback_data=f"edit:type:{draft_id}"),
-        ],
-        [
-            InlineKeyboardButton(t(lang, "btn_back"), callback_data=f"draft:back:{draft_id}"),
-        ],
-    ])
+    return _bind_draft_kb(_draft_edit_layout(lang), draft_id)
 
 def kb_categories(lang: str, draft_id: str, tx_type: str) -> InlineKeyboardMarkup:
     """Category picker based on transaction type"""
-    cats = CATEGORIES.get(tx_type, CATEGORIES["expense"])
-    rows = []
-    row = []
-    for key, emoji in cats:
-        btn_text = f"{emoji} {key.capitalize()}"
-        row.append(InlineKeyboardButton(btn_text, callback_data=f"pickcat:{key}:{draft_id}"))
-        if len(row) == 2:
-            rows.append(row)
-            row = []
-    if row:
-        rows.append(row)
-    rows.append([InlineKeyboardButton(t(lang, "btn_back"), callback_data=f"draft:edit:{draft_id}")])
-    return InlineKeyboardMarkup(rows)
+    return _bind_draft_kb(_categories_layout(lang, tx_type), draft_id)
 
 def kb_tx_type(lang: str, draft_id: str) -> InlineKeyboardMarkup:
     """Transaction type picker"""
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton(t(lang, "type_expense"), callback_data=f"picktype:expense:{draft_id}")],
-        [InlineKeyboardButton(t(lang, "type_income"), callback_data=f"picktype:income:{draft_id}")],
-        [InlineKeyboardButton(t(lang, "type_debt"), callback_data=f"picktype:debt:{draft_id}")],
-        [InlineKeyboardButton(t(lang, "btn_back"), callback_data=f"draft:edit:{draft_id}")],
-    ])
+    return _bind_draft_kb(_tx_type_layout(lang), draft_id)
 
+@lru_cache(maxsize=None)
 def kb_app(lang: str) -> InlineKeyboardMarkup:
     """App button with WebApp"""
     if WEBAPP_URL:
@@ -653,36 +825,55 @@ def kb_app(lang: str) -> InlineKeyboardMarkup:
 # FORMATTERS
 # ══════════════════════════════════════════════════════════════════════════════
 
+_TYPE_LABELS = {
+    lang: {
+        "expense": t(lang, "type_expense"),
+        "income": t(lang, "type_income"),
+        "debt": t(lang, "type_debt"),
+    }
+    for lang in I18N
+}
+
+_DRAFT_LABELS = {
+    lang: {
+        "title": t(lang, "draft_title"),
+        "type": t(lang, "draft_type"),
+        "category": t(lang, "draft_category"),
+        "amount": t(lang, "draft_amount"),
+        "desc": t(lang, "draft_desc"),
+        "source": t(lang, "draft_source"),
+    }
+    for lang in I18N
+}
+
+_SOURCE_LABELS = {
+    "text": "⌨️ Text",
+    "voice": "🎙 Voice",
+    "receipt": "🧾 Receipt",
+}
+
+@lru_cache(maxsize=4096)
 def format_amount(amount: int) -> str:
     """Format number with thousands separator"""
     return f"{amount:,}".replace(",", " ")
 
 def format_draft(lang: str, d: Draft, raw_text: str = "") -> str:
     """Format draft for confirmation - clean card style"""
-    type_labels = {
-        "expense": t(lang, "type_expense"),
-        "income": t(lang, "type_income"),
-        "debt": t(lang, "type_debt"),
-    }
-    
-    source_labels = {
-        "text": "⌨️ Text",
-        "voice": "🎙 Voice",
-        "receipt": "🧾 Receipt",
-    }
+    labels = _DRAFT_LABELS.get(lang, _DRAFT_LABELS["uz"])
+    type_labels = _TYPE_LABELS.get(lang, _TYPE_LABELS["uz"])
     
     lines = [
-        t(lang, "draft_title"),
+        labels["title"],
         "",
-        f"{t(lang, 'draft_type')}: {type_labels.get(d.tx_type, d.tx_type)}",
-        f"{t(lang, 'draft_category')}: {d.category_key.capitalize()}",
-        f"{t(lang, 'draft_amount')}: *{format_amount(d.amount)}* so'm",
+        f"{labels['type']}: {type_labels.get(d.tx_type, d.tx_type)}",
+        f"{labels['category']}: {d.category_key.capitalize()}",
+        f"{labels['amount']}: *{format_amount(d.amount)}* so'm",
     ]
     
     if d.description:
-        lines.append(f"{t(lang, 'draft_desc')}: {d.description}")
+        lines.append(f"{labels['desc']}: {d.description}")
     
-    lines.append(f"{t(lang, 'draft_source')}: {source_labels.get(d.source, d.source)}")
+    lines.append(f"{labels['source']}: {_SOURCE_LABELS.get(d.source, d.source)}")
     
     if raw_text:
         lines.append("")
@@ -695,43 +886,95 @@ def format_draft(lang: str, d: Draft, raw_text: str = "") -> str:
 # VOICE TRANSCRIPTION
 # ══════════════════════════════════════════════════════════════════════════════
 
-async def transcribe_voice(file_bytes: bytes) -> Optional[str]:
+_openai: Optional[AsyncOpenAI] = None
+
+# file_unique_id -> transcript. Forwarded or resent voice notes keep their
+# file_unique_id, so a hit skips both the download and the Whisper call.
+TRANSCRIPTS: "TTLCache[str, str]" = TTLCache(maxsize=1024, ttl=3600)
+# file_unique_id -> in-flight transcription, shared by duplicate uploads
+TRANSCRIBING: Dict[str, "asyncio.Future[Optional[str]]"] = {}
+# Caps concurrent Whisper uploads so a burst of voice notes can't trip 429s
+WHISPER_SEM = asyncio.Semaphore(8)
+
+def get_openai() -> AsyncOpenAI:
+    """Shared OpenAI client, so TLS connections to the API are reused"""
+    global _openai
+    if _openai is None:
+        _openai = AsyncOpenAI(api_key=OPENAI_API_KEY)
+    return _openai
+
+async def transcribe_voice(audio: BinaryIO) -> Optional[str]:
     """Transcribe voice using OpenAI Whisper"""
     if not OPENAI_API_KEY:
         return None
     try:
-        from openai import OpenAI
-        client = OpenAI(api_key=OPENAI_API_KEY)
-        resp = client.audio.transcriptions.create(
-            model="whisper-1",
-            file=("voice.ogg", file_bytes),
-            language="uz",  # Can be improved with language detection
-        )
+        async with WHISPER_SEM:
+            resp = await get_openai().audio.transcriptions.create(
+                model="whisper-1",
+                file=("voice.ogg", audio),
+                language="uz",  # Can be improved with language detection
+            )
         return (resp.text or "").strip()
-    except Exception as e:
-        print(f"Voice transcription error: {e}")
+    except Exception:
+        LOG.exception("Voice transcription failed")
         return None
 
+async def fetch_transcript(bot, voice) -> Optional[str]:
+    file = await bot.get_file(voice.file_id)
+    
+    # Download voice file straight into the buffer handed to Whisper
+    audio = io.BytesIO()
+    await file.download_to_memory(audio)
+    audio.seek(0)
+    
+    text = await transcribe_voice(audio)
+    if text:
+        TRANSCRIPTS[voice.file_unique_id] = text
+    return text
+
+async def get_transcript(bot, voice) -> Optional[str]:
+    """Transcript of a voice note: cached, else one shared transcription"""
+    key = voice.file_unique_id
+    text = TRANSCRIPTS.get(key)
+    if text is not None:
+        return text
+    
+    fetch = TRANSCRIBING.get(key)
+    if fetch is None:
+        fetch = asyncio.ensure_future(fetch_transcript(bot, voice))
+        TRANSCRIBING[key] = fetch
+        fetch.add_done_callback(lambda _: TRANSCRIBING.pop(key, None))
+    return await asyncio.shield(fetch)
+
 
 # ══════════════════════════════════════════════════════════════════════════════
 # HANDLERS
 # ══════════════════════════════════════════════════════════════════════════════
 
+# Welcome message arguments per language; only ever spread into reply_text
+_WELCOME_KW = {
+    lang: {
+        "text": t(lang, "welcome"),
+        "parse_mode": ParseMode.MARKDOWN,
+        "reply_markup": kb_main_menu(lang),
+    }
+    for lang in I18N
+}
+
+def welcome_kwargs(lang: str) -> dict:
+    return _WELCOME_KW.get(lang, _WELCOME_KW["uz"])
+
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command"""
     tg_id = update.effective_user.id
-    lang = await get_user_lang(tg_id)
+    lang = await get_user_lang(tg_id, context)
     
-    await update.message.reply_text(
-        t(lang, "welcome"),
-        parse_mode=ParseMode.MARKDOWN,
-        reply_markup=kb_main_menu(lang)
-    )
+    await update.message.reply_text(**welcome_kwargs(lang))
 
 async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /help command"""
     tg_id = update.effective_user.id
-    lang = await get_user_lang(tg_id)
+    lang = await get_user_lang(tg_id, context)
     
     await update.message.reply_text(
         t(lang, "help_text"),
@@ -741,7 +984,7 @@ async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /stats command"""
     tg_id = update.effective_user.id
-    lang = await get_user_lang(tg_id)
+    lang = await get_user_lang(tg_id, context)
     
     await update.message.reply_text(
         t(lang, "stats_title"),
@@ -749,247 +992,247 @@ async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=kb_stats(lang)
     )
 
+# ═══════════════════════════════════════════════════════════════════
+# CALLBACKS - one handler per callback_data prefix
+# Each receives the rest of the data after "prefix:".
+# ═══════════════════════════════════════════════════════════════════
+
+async def handle_lang_cb(query, context: ContextTypes.DEFAULT_TYPE, tg_id: int, lang: str, rest: str):
+    """Language selection"""
+    new_lang = rest
+    await set_user_lang(tg_id, new_lang, context)
+    
+    await query.edit_message_text(
+        t(new_lang, "lang_changed"),
+        parse_mode=ParseMode.MARKDOWN
+    )
+    
+    await query.message.reply_text(**welcome_kwargs(new_lang))
+
+# Bound str.format of each language's stats template
+_STATS_FMT = {lang: t(lang, "stats_result").format for lang in I18N}
+
+async def handle_stats_cb(query, context: ContextTypes.DEFAULT_TYPE, tg_id: int, lang: str, rest: str):
+    """Statistics"""
+    period = rest
+    
+    if period == "csv":
+        content = await api_stream("/export/csv", {"telegram_id": tg_id}, io.BytesIO())
+        await query.message.reply_document(
+            document=content,
+            filename=time.strftime("hamyon_export_%Y%m%d.csv"),
+            caption=t(lang, "csv_caption")
+        )
+        return
+    
+    days = int(period)
+    if days == 1:
+        result = await api_get("/stats/today", {"telegram_id": tg_id})
+        period_text = t(lang, "stats_today")
+    else:
+        result = await api_get("/stats/range", {"telegram_id": tg_id, "days": days})
+        period_text = f"📆 {days} " + ("kun" if lang == "uz" else "дней" if lang == "ru" else "days")
+    
+    text = _STATS_FMT.get(lang, _STATS_FMT["uz"])(
+        period=period_text,
+        expense=result.get("expense", 0),
+        income=result.get("income", 0),
+        debt=result.get("debt", 0),
+        count=result.get("count", 0)
+    )
+    
+    await query.edit_message_text(
+        text,
+        parse_mode=ParseMode.MARKDOWN,
+        reply_markup=kb_stats(lang)
+    )
+
+async def handle_settings_cb(query, context: ContextTypes.DEFAULT_TYPE, tg_id: int, lang: str, rest: str):
+    """Settings"""
+    action = rest
+    
+    if action == "lang":
+        await query.edit_message_text(
+            t(lang, "choose_lang"),
+            parse_mode=ParseMode.MARKDOWN,
+            reply_markup=kb_language()
+        )
+    elif action == "help":
+        await query.edit_message_text(
+            t(lang, "help_text"),
+            parse_mode=ParseMode.MARKDOWN
+        )
+
+_QUICKADD_PROMPTS = {
+    "expense": "💸 Xarajatni yozing:\n`taksi 20000` yoki `ovqat 45000`",
+    "income": "💰 Daromadni yozing:\n`maosh 5000000` yoki `bonus 500000`",
+    "debt": "📋 Qarzni yozing:\n`qarz 200000 Ali`",
+}
+
+async def handle_quickadd_cb(query, context: ContextTypes.DEFAULT_TYPE, tg_id: int, lang: str, rest: str):
+    """Quick add"""
+    tx_type = rest
+    USER_STATE[tg_id] = f"quickadd:{tx_type}"
+    
+    await query.edit_message_text(
+        _QUICKADD_PROMPTS.get(tx_type, _QUICKADD_PROMPTS["expense"]),
+        parse_mode=ParseMode.MARKDOWN
+    )
+
+async def handle_draft_cb(query, context: ContextTypes.DEFAULT_TYPE, tg_id: int, lang: str, rest: str):
+    """Draft actions"""
+    action, _, draft_id = rest.partition(":")
+    key = (tg_id, draft_id)
+    
+    if action == "cancel":
+        DRAFTS.pop(key, None)
+        EDIT_MODE.pop(tg_id, None)
+        await query.edit_message_text(t(lang, "cancelled"))
+        return
+    
+    draft = DRAFTS.get(key)
+    if not draft:
+        await query.edit_message_text(t(lang, "not_found"))
+        return
+    
+    if action == "save":
+        # Claim the draft before awaiting, so a double tap can't save it twice
+        DRAFTS.pop(key, None)
+        try:
+            await api_post("/transactions", {
+                "telegram_id": tg_id,
+                "type": draft.tx_type,
+                "amount": draft.amount,
+                "category_key": draft.category_key,
+                "description": draft.description,
+                "source": draft.source,
+            })
+        except Exception as e:
+            # Hand the draft back only if retrying can't save it twice
+            if api_write_not_applied(e):
+                DRAFTS[key] = draft
+            raise
+        EDIT_MODE.pop(tg_id, None)
+        
+        await query.edit_message_text(
+            t(lang, "saved"),
+            parse_mode=ParseMode.MARKDOWN
+        )
+        return
+    
+    if action == "edit":
+        await query.edit_message_text(
+            t(lang, "edit_title"),
+            parse_mode=ParseMode.MARKDOWN,
+            reply_markup=kb_draft_edit(lang, draft_id)
+        )
+        return
+    
+    if action == "back":
+        await query.edit_message_text(
+            format_draft(lang, draft),
+            parse_mode=ParseMode.MARKDOWN,
+            reply_markup=kb_draft_confirm(lang, draft_id)
+        )
+
+async def handle_edit_cb(query, context: ContextTypes.DEFAULT_TYPE, tg_id: int, lang: str, rest: str):
+    """Edit actions"""
+    field, _, draft_id = rest.partition(":")
+    key = (tg_id, draft_id)
+    draft = DRAFTS.get(key)
+    
+    if not draft:
+        await query.edit_message_text(t(lang, "not_found"))
+        return
+    
+    if field == "cat":
+        await query.edit_message_text(
+            t(lang, "ask_category"),
+            parse_mode=ParseMode.MARKDOWN,
+            reply_markup=kb_categories(lang, draft_id, draft.tx_type)
+        )
+    elif field == "type":
+        await query.edit_message_text(
+            t(lang, "ask_type"),
+            parse_mode=ParseMode.MARKDOWN,
+            reply_markup=kb_tx_type(lang, draft_id)
+        )
+    elif field == "amt":
+        EDIT_MODE[tg_id] = (draft_id, "amount")
+        await query.edit_message_text(
+            t(lang, "ask_amount"),
+            parse_mode=ParseMode.MARKDOWN
+        )
+    elif field == "desc":
+        EDIT_MODE[tg_id] = (draft_id, "description")
+        await query.edit_message_text(
+            t(lang, "ask_desc"),
+            parse_mode=ParseMode.MARKDOWN
+        )
+
+async def handle_pickcat_cb(query, context: ContextTypes.DEFAULT_TYPE, tg_id: int, lang: str, rest: str):
+    """Pick category"""
+    cat, _, draft_id = rest.partition(":")
+    key = (tg_id, draft_id)
+    draft = DRAFTS.get(key)
+    
+    if not draft:
+        await query.edit_message_text(t(lang, "not_found"))
+        return
+    
+    draft.category_key = cat
+    await query.edit_message_text(
+        format_draft(lang, draft),
+        parse_mode=ParseMode.MARKDOWN,
+        reply_markup=kb_draft_confirm(lang, draft_id)
+    )
+
+async def handle_picktype_cb(query, context: ContextTypes.DEFAULT_TYPE, tg_id: int, lang: str, rest: str):
+    """Pick type"""
+    tx_type, _, draft_id = rest.partition(":")
+    key = (tg_id, draft_id)
+    draft = DRAFTS.get(key)
+    
+    if not draft:
+        await query.edit_message_text(t(lang, "not_found"))
+        return
+    
+    draft.tx_type = tx_type
+    await query.edit_message_text(
+        format_draft(lang, draft),
+        parse_mode=ParseMode.MARKDOWN,
+        reply_markup=kb_draft_confirm(lang, draft_id)
+    )
+
+CALLBACK_HANDLERS = {
+    "lang": handle_lang_cb,
+    "stats": handle_stats_cb,
+    "settings": handle_settings_cb,
+    "quickadd": handle_quickadd_cb,
+    "draft": handle_draft_cb,
+    "edit": handle_edit_cb,
+    "pickcat": handle_pickcat_cb,
+    "picktype": handle_picktype_cb,
+}
+
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle all inline button callbacks"""
     query = update.callback_query
-    await query.answer()
-    
     tg_id = query.from_user.id
-    lang = await get_user_lang(tg_id)
-    data = query.data
+    
+    # Stop the button spinner while the language is looked up
+    _, lang = await asyncio.gather(query.answer(), get_user_lang(tg_id, context))
+    prefix, _, rest = query.data.partition(":")
+    handler = CALLBACK_HANDLERS.get(prefix)
+    if handler is None:
+        return
     
     try:
-        # ═══════════════════════════════════════════════════════════════════
-        # LANGUAGE SELECTION
-        # ═══════════════════════════════════════════════════════════════════
-        if data.startswith("lang:"):
-            new_lang = data.split(":")[1]
-            await set_user_lang(tg_id, new_lang)
-            
-            await query.edit_message_text(
-                t(new_lang, "lang_changed"),
-                parse_mode=ParseMode.MARKDOWN
-            )
-            
-            await query.message.reply_text(
-                t(new_lang, "welcome"),
-                parse_mode=ParseMode.MARKDOWN,
-                reply_markup=kb_main_menu(new_lang)
-            )
-            return
-        
-        # ═══════════════════════════════════════════════════════════════════
-        # STATISTICS
-        # ═══════════════════════════════════════════════════════════════════
-        if data.startswith("stats:"):
-            period = data.split(":")[1]
-            
-            if period == "csv":
-                _, response = await api_get("/export/csv", {"telegram_id": tg_id})
-                await query.message.reply_document(
-                    document=response.content,
-                    filename=f"hamyon_export_{datetime.now().strftime('%Y%m%d')}.csv",
-                    caption=t(lang, "csv_caption")
-                )
-                return
-            
-            days = int(period)
-            if days == 1:
-                result, _ = await api_get("/stats/today", {"telegram_id": tg_id})
-                period_text = t(lang, "stats_today")
-            else:
-                result, _ = await api_get("/stats/range", {"telegram_id": tg_id, "days": days})
-                period_text = f"📆 {days} " + ("kun" if lang == "uz" else "дней" if lang == "ru" else "days")
-            
-            text = t(lang, "stats_result").format(
-                period=period_text,
-                expense=result.get("expense", 0),
-                income=result.get("income", 0),
-                debt=result.get("debt", 0),
-                count=result.get("count", 0)
-            )
-            
-            await query.edit_message_text(
-                text,
-                parse_mode=ParseMode.MARKDOWN,
-                reply_markup=kb_stats(lang)
-            )
-            return
-        
-        # ═══════════════════════════════════════════════════════════════════
-        # SETTINGS
-        # ═══════════════════════════════════════════════════════════════════
-        if data.startswith("settings:"):
-            action = data.split(":")[1]
-            
-            if action == "lang":
-                await query.edit_message_text(
-                    t(lang, "choose_lang"),
-                    parse_mode=ParseMode.MARKDOWN,
-                    reply_markup=kb_language()
-                )
-            elif action == "help":
-                await query.edit_message_text(
-                    t(lang, "help_text"),
-                    parse_mode=ParseMode.MARKDOWN
-                )
-            return
-        
-        # ═══════════════════════════════════════════════════════════════════
-        # QUICK ADD
-        # ═══════════════════════════════════════════════════════════════════
-        if data.startswith("quickadd:"):
-            tx_type = data.split(":")[1]
-            USER_STATE[tg_id] = f"quickadd:{tx_type}"
-            
-            prompt = {
-                "expense": "💸 Xarajatni yozing:\n`taksi 20000` yoki `ovqat 45000`",
-                "income": "💰 Daromadni yozing:\n`maosh 5000000` yoki `bonus 500000`",
-                "debt": "📋 Qarzni yozing:\n`qarz 200000 Ali`",
-            }
-            
-            await query.edit_message_text(
-                prompt.get(tx_type, prompt["expense"]),
-                parse_mode=ParseMode.MARKDOWN
-            )
-            return
-        
-        # ═══════════════════════════════════════════════════════════════════
-        # DRAFT ACTIONS
-        # ═══════════════════════════════════════════════════════════════════
-        if data.startswith("draft:"):
-            _, action, draft_id = data.split(":")
-            key = (tg_id, draft_id)
-            
-            if action == "cancel":
-                if key in DRAFTS:
-                    del DRAFTS[key]
-                if tg_id in EDIT_MODE:
-                    del EDIT_MODE[tg_id]
-                await query.edit_message_text(t(lang, "cancelled"))
-                return
-            
-            draft = DRAFTS.get(key)
-            if not draft:
-                await query.edit_message_text(t(lang, "not_found"))
-                return
-            
-            if action == "save":
-                await api_post("/transactions", {
-                    "telegram_id": tg_id,
-                    "type": draft.tx_type,
-                    "amount": draft.amount,
-                    "category_key": draft.category_key,
-                    "description": draft.description,
-                    "source": draft.source,
-                })
-                del DRAFTS[key]
-                if tg_id in EDIT_MODE:
-                    del EDIT_MODE[tg_id]
-                
-                await query.edit_message_text(
-                    t(lang, "saved"),
-                    parse_mode=ParseMode.MARKDOWN
-                )
-                return
-            
-            if action == "edit":
-                await query.edit_message_text(
-                    t(lang, "edit_title"),
-                    parse_mode=ParseMode.MARKDOWN,
-                    reply_markup=kb_draft_edit(lang, draft_id)
-                )
-                return
-            
-            if action == "back":
-                await query.edit_message_text(
-                    format_draft(lang, draft),
-                    parse_mode=ParseMode.MARKDOWN,
-                    reply_markup=kb_draft_confirm(lang, draft_id)
-                )
-                return
-        
-        # ═══════════════════════════════════════════════════════════════════
-        # EDIT ACTIONS
-        # ═══════════════════════════════════════════════════════════════════
-        if data.startswith("edit:"):
-            _, field, draft_id = data.split(":")
-            key = (tg_id, draft_id)
-            draft = DRAFTS.get(key)
-            
-            if not draft:
-                await query.edit_message_text(t(lang, "not_found"))
-                return
-            
-            if field == "cat":
-                await query.edit_message_text(
-                    t(lang, "ask_category"),
-                    parse_mode=ParseMode.MARKDOWN,
-                    reply_markup=kb_categories(lang, draft_id, draft.tx_type)
-                )
-            elif field == "type":
-                await query.edit_message_text(
-                    t(lang, "ask_type"),
-                    parse_mode=ParseMode.MARKDOWN,
-                    reply_markup=kb_tx_type(lang, draft_id)
-                )
-            elif field == "amt":
-                EDIT_MODE[tg_id] = (draft_id, "amount")
-                await query.edit_message_text(
-                    t(lang, "ask_amount"),
-                    parse_mode=ParseMode.MARKDOWN
-                )
-            elif field == "desc":
-                EDIT_MODE[tg_id] = (draft_id, "description")
-                await query.edit_message_text(
-                    t(lang, "ask_desc"),
-                    parse_mode=ParseMode.MARKDOWN
-                )
-            return
-        
-        # ═══════════════════════════════════════════════════════════════════
-        # PICK CATEGORY
-        # ═══════════════════════════════════════════════════════════════════
-        if data.startswith("pickcat:"):
-            _, cat, draft_id = data.split(":")
-            key = (tg_id, draft_id)
-            draft = DRAFTS.get(key)
-            
-            if not draft:
-                await query.edit_message_text(t(lang, "not_found"))
-                return
-            
-            draft.category_key = cat
-            await query.edit_message_text(
-                format_draft(lang, draft),
-                parse_mode=ParseMode.MARKDOWN,
-                reply_markup=kb_draft_confirm(lang, draft_id)
-            )
-            return
-        
-        # ═══════════════════════════════════════════════════════════════════
-        # PICK TYPE
-        # ═══════════════════════════════════════════════════════════════════
-        if data.startswith("picktype:"):
-            _, tx_type, draft_id = data.split(":")
-            key = (tg_id, draft_id)
-            draft = DRAFTS.get(key)
-            
-            if not draft:
-                await query.edit_message_text(t(lang, "not_found"))
-                return
-            
-            draft.tx_type = tx_type
-            await query.edit_message_text(
-                format_draft(lang, draft),
-                parse_mode=ParseMode.MARKDOWN,
-                reply_markup=kb_draft_confirm(lang, draft_id)
-            )
-            return
+        await handler(query, context, tg_id, lang, rest)
     
     except Exception as e:
         error_msg = str(e)
-        print(f"❌ Callback error: {error_msg}")
+        LOG.exception("Callback failed tg_id=%s data=%s", tg_id, query.data)
         
         # Show more helpful error to user
         if "ConnectError" in error_msg or "Connection" in error_msg:
@@ -999,71 +1242,109 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await query.message.reply_text(f"⚠️ {t(lang, 'error')}: {error_msg[:100]}")
 
-async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle text messages"""
-    tg_id = update.effective_user.id
-    lang = await get_user_lang(tg_id)
-    text = (update.message.text or "").strip()
-    
-    # ═══════════════════════════════════════════════════════════════════════
-    # MENU BUTTON HANDLERS
-    # ═══════════════════════════════════════════════════════════════════════
-    
-    # Add button
-    if text in [t(l, "btn_add") for l in ["uz", "ru", "en"]]:
-        await update.message.reply_text(
-            t(lang, "quick_add_title"),
-            parse_mode=ParseMode.MARKDOWN,
-            reply_markup=kb_quick_add(lang)
-        )
-        return
+async def reply_new_draft(
+    update: Update,
+    lang: str,
+    parsed: Tuple[str, int, Optional[str]],
+    tx_type: str,
+    source: str,
+    raw_text: str,
+):
+    """Store a draft from parsed input and send its confirmation card"""
+    cat, amount, desc = parsed
+    draft_id = new_draft_id()
     
-    # Stats button
-    if text in [t(l, "btn_stats") for l in ["uz", "ru", "en"]]:
-        await update.message.reply_text(
-            t(lang, "stats_title"),
-            parse_mode=ParseMode.MARKDOWN,
-            reply_markup=kb_stats(lang)
-        )
-        return
+    draft = Draft(
+        tx_type=tx_type,
+        category_key=cat,
+        amount=amount,
+        description=desc,
+        source=source
+    )
+    DRAFTS[(update.effective_user.id, draft_id)] = draft
     
-    # Settings button
-    if text in [t(l, "btn_settings") for l in ["uz", "ru", "en"]]:
+    await update.message.reply_text(
+        format_draft(lang, draft, raw_text=raw_text),
+        parse_mode=ParseMode.MARKDOWN,
+        reply_markup=kb_draft_confirm(lang, draft_id)
+    )
+
+# ═══════════════════════════════════════════════════════════════════
+# MENU BUTTONS - reply keyboard presses arrive as plain text
+# ═══════════════════════════════════════════════════════════════════
+
+async def show_quick_add(update: Update, lang: str):
+    await update.message.reply_text(
+        t(lang, "quick_add_title"),
+        parse_mode=ParseMode.MARKDOWN,
+        reply_markup=kb_quick_add(lang)
+    )
+
+async def show_stats(update: Update, lang: str):
+    await update.message.reply_text(
+        t(lang, "stats_title"),
+        parse_mode=ParseMode.MARKDOWN,
+        reply_markup=kb_stats(lang)
+    )
+
+async def show_settings(update: Update, lang: str):
+    await update.message.reply_text(
+        t(lang, "settings_title"),
+        parse_mode=ParseMode.MARKDOWN,
+        reply_markup=kb_settings(lang)
+    )
+
+async def show_app(update: Update, lang: str):
+    kb = kb_app(lang)
+    if kb:
         await update.message.reply_text(
-            t(lang, "settings_title"),
+            t(lang, "app_title"),
             parse_mode=ParseMode.MARKDOWN,
-            reply_markup=kb_settings(lang)
+            reply_markup=kb
         )
-        return
+    else:
+        await update.message.reply_text(t(lang, "app_not_set"))
+
+# Button label in every language -> handler; replies use the user's language
+BTN_DISPATCH = {
+    t(l, key): show
+    for key, show in (
+        ("btn_add", show_quick_add),
+        ("btn_stats", show_stats),
+        ("btn_settings", show_settings),
+        ("btn_app", show_app),
+    )
+    for l in I18N
+}
+
+async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle text messages"""
+    tg_id = update.effective_user.id
+    lang = await get_user_lang(tg_id, context)
+    text = (update.message.text or "").strip()
     
-    # App button
-    if text in [t(l, "btn_app") for l in ["uz", "ru", "en"]]:
-        kb = kb_app(lang)
-        if kb:
-            await update.message.reply_text(
-                t(lang, "app_title"),
-                parse_mode=ParseMode.MARKDOWN,
-                reply_markup=kb
-            )
-        else:
-            await update.message.reply_text(t(lang, "app_not_set"))
+    # Menu buttons (in any language)
+    show = BTN_DISPATCH.get(text)
+    if show:
+        await show(update, lang)
         return
     
     # ═══════════════════════════════════════════════════════════════════════
     # EDIT MODE - User is editing a draft field
     # ═══════════════════════════════════════════════════════════════════════
-    if tg_id in EDIT_MODE:
-        draft_id, field = EDIT_MODE[tg_id]
+    edit = EDIT_MODE.get(tg_id)
+    if edit:
+        draft_id, field = edit
         key = (tg_id, draft_id)
         draft = DRAFTS.get(key)
         
         if not draft:
-            del EDIT_MODE[tg_id]
+            EDIT_MODE.pop(tg_id, None)
             await update.message.reply_text(t(lang, "not_found"))
             return
         
         if field == "amount":
-            digits = "".join(ch for ch in text if ch.isdigit())
+            digits = NON_DIGIT_RE.sub("", text)
             if not digits:
                 await update.message.reply_text(
                     t(lang, "ask_amount"),
@@ -1071,11 +1352,11 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return
             draft.amount = int(digits)
-            del EDIT_MODE[tg_id]
+            EDIT_MODE.pop(tg_id, None)
         
         elif field == "description":
             draft.description = None if text == "-" else text
-            del EDIT_MODE[tg_id]
+            EDIT_MODE.pop(tg_id, None)
         
         await update.message.reply_text(
             format_draft(lang, draft),
@@ -1090,11 +1371,9 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Determine transaction type from state or default
     tx_type = "expense"
-    if tg_id in USER_STATE:
-        state = USER_STATE[tg_id]
-        if state.startswith("quickadd:"):
-            tx_type = state.split(":")[1]
-        del USER_STATE[tg_id]
+    state = USER_STATE.pop(tg_id, None)
+    if state and state.startswith("quickadd:"):
+        tx_type = state.split(":")[1]
     
     # Try to parse the text
     parsed = parse_one(text)
@@ -1105,39 +1384,21 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    cat, amount, desc = parsed
-    draft_id = uuid.uuid4().hex[:8]
-    
-    draft = Draft(
-        tx_type=tx_type,
-        category_key=normalize_category(cat),
-        amount=amount,
-        description=desc,
-        source="text"
-    )
-    DRAFTS[(tg_id, draft_id)] = draft
-    
-    await update.message.reply_text(
-        format_draft(lang, draft, raw_text=text),
-        parse_mode=ParseMode.MARKDOWN,
-        reply_markup=kb_draft_confirm(lang, draft_id)
-    )
+    await reply_new_draft(update, lang, parsed, tx_type=tx_type, source="text", raw_text=text)
 
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle voice messages"""
     tg_id = update.effective_user.id
-    lang = await get_user_lang(tg_id)
     
     voice = update.message.voice
     if not voice:
         return
     
-    # Download voice file
-    file = await context.bot.get_file(voice.file_id)
-    file_bytes = await file.download_as_bytearray()
-    
-    # Transcribe
-    text = await transcribe_voice(bytes(file_bytes))
+    # Language lookup and transcription are independent
+    lang, text = await asyncio.gather(
+        get_user_lang(tg_id, context),
+        get_transcript(context.bot, voice),
+    )
     if not text:
         await update.message.reply_text(t(lang, "voice_no_key"))
         return
@@ -1151,49 +1412,91 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    cat, amount, desc = parsed
-    draft_id = uuid.uuid4().hex[:8]
-    
-    draft = Draft(
-        tx_type="expense",
-        category_key=normalize_category(cat),
-        amount=amount,
-        description=desc,
-        source="voice"
-    )
-    DRAFTS[(tg_id, draft_id)] = draft
-    
-    await update.message.reply_text(
-        format_draft(lang, draft, raw_text=text),
-        parse_mode=ParseMode.MARKDOWN,
-        reply_markup=kb_draft_confirm(lang, draft_id)
-    )
+    await reply_new_draft(update, lang, parsed, tx_type="expense", source="voice", raw_text=text)
 
 
 # ══════════════════════════════════════════════════════════════════════════════
 # MAIN
 # ══════════════════════════════════════════════════════════════════════════════
 
+# Updates are processed concurrently; a chat's lock keeps its own updates in
+# order (draft edits, quick-add state). Locks are dropped once no update holds them.
+CHAT_LOCKS: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+# Messages older than this are dropped unhandled: after a backlog nobody is
+# still waiting for the answer. Callback queries carry no send time of their
+# own (their message's date is when the card was posted), so they always run.
+STALE_MESSAGE_AGE = 30  # seconds
+
+async def drop_stale_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message
+    if msg and time.time() - msg.date.timestamp() > STALE_MESSAGE_AGE:
+        LOG.info("Dropping stale message chat_id=%s age=%.0fs", msg.chat_id, time.time() - msg.date.timestamp())
+        raise ApplicationHandlerStop
+
+def per_chat(handler):
+    """Serialize a handler per chat, leaving different chats concurrent"""
+    @wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        chat = update.effective_chat
+        if chat is None:
+            return await handler(update, context)
+        lock = CHAT_LOCKS.get(chat.id)
+        if lock is None:
+            lock = CHAT_LOCKS[chat.id] = asyncio.Lock()
+        async with lock:
+            return await handler(update, context)
+    return wrapper
+
 def main():
     """Start the bot"""
-    print("🚀 Starting Hamyon Bot...")
+    setup_logging()
+    LOG.info("🚀 Starting Hamyon Bot...")
     
-    app = Application.builder().token(TOKEN).build()
+    try:
+        import uvloop  # optional: faster event loop where available (not on Windows)
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+    
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(True)
+        # Paces outgoing calls to Telegram's flood limits and retries RetryAfter
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        .post_shutdown(close_http)
+        .build()
+    )
+    
+    # Runs before every other group
+    app.add_handler(TypeHandler(Update, drop_stale_messages), group=-1)
     
     # Commands
-    app.add_handler(CommandHandler("start", cmd_start))
-    app.add_handler(CommandHandler("help", cmd_help))
-    app.add_handler(CommandHandler("stats", cmd_stats))
+    app.add_handler(CommandHandler("start", per_chat(cmd_start)))
+    app.add_handler(CommandHandler("help", per_chat(cmd_help)))
+    app.add_handler(CommandHandler("stats", per_chat(cmd_stats)))
     
     # Callbacks
-    app.add_handler(CallbackQueryHandler(handle_callback))
+    app.add_handler(CallbackQueryHandler(per_chat(handle_callback)))
     
     # Messages
-    app.add_handler(MessageHandler(filters.VOICE, handle_voice))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    app.add_handler(MessageHandler(filters.VOICE, per_chat(handle_voice)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, per_chat(handle_text)))
     
-    print("✅ Bot is running!")
-    app.run_polling(drop_pending_updates=True)
+    LOG.info("✅ Bot is running!")
+    if WEBHOOK_URL:
+        # Telegram pushes updates to us: no getUpdates long-poll round-trip
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path=TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TOKEN}",
+            secret_token=WEBHOOK_SECRET,
+            drop_pending_updates=True,
+        )
+    else:
+        app.run_polling(drop_pending_updates=True)
 
 if __name__ == "__main__":
     main()
@@ -5,7 +5,18 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("Missing DATABASE_URL (Railway Postgres).")
 
-pool = AsyncConnectionPool(conninfo=DATABASE_URL, min_size=1, max_size=10)
+# Every endpoint runs a single statement, so autocommit saves the separate
+# BEGIN/COMMIT round-trips; multi-statement work opens conn.transaction().
+pool = AsyncConnectionPool(
+    conninfo=DATABASE_URL,
+    min_size=5,
+    max_size=25,
+    max_idle=60,
+    max_lifetime=3600,
+    num_workers=3,
+    kwargs={"autocommit": True, "application_name": "hamyon-api"},
+    open=False,
+)
 
 async def open_pool():
     # No .opened attribute in this psycopg_pool version
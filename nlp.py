@@ -4,6 +4,7 @@ Parses expense/income text in multiple languages
 """
 
 import re
+from functools import lru_cache
 from typing import Optional, Tuple, List
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -226,24 +227,37 @@ CAT_MAP = {
     "borrow": "debt",
 }
 
+# Standard category keys (the distinct CAT_MAP targets), for O(1) membership
+CATEGORY_KEYS = frozenset(CAT_MAP.values())
+
 # Amount pattern - supports various formats
 AMOUNT_RE = re.compile(r"(\d[\d\s.,]*\d|\d+)")
 
+# Thousands suffixes: 50k / 50 ming / 50 тыс -> 50000
+THOUSANDS_RE = re.compile(r"(\d+)\s*(?:k|ming|тыс)\b", re.IGNORECASE)
+
+# Separators between entries in multi-entry input
+ENTRY_SPLIT_RE = re.compile(r"[;\n]+")
+
+# Everything but decimal digits (\d is exactly str.isdecimal)
+NON_DIGIT_RE = re.compile(r"\D+")
+
 def _normalize_amount(s: str) -> Optional[int]:
     """Extract integer from amount string"""
-    digits = "".join(ch for ch in s if ch.isdigit())
+    if s.isdecimal():  # the usual "20000"
+        return int(s)
+    # Only decimal digits survive, which int() always accepts
+    digits = NON_DIGIT_RE.sub("", s)
     if not digits:
         return None
-    try:
-        return int(digits)
-    except:
-        return None
+    return int(digits)
 
 def normalize_category(word: str) -> str:
     """Normalize category word to standard key"""
     w = word.strip().lower()
     return CAT_MAP.get(w, w)
 
+@lru_cache(maxsize=4096)
 def parse_one(text: str) -> Optional[Tuple[str, int, Optional[str]]]:
     """
     Parse a single expense/income entry.
@@ -255,6 +269,8 @@ def parse_one(text: str) -> Optional[Tuple[str, int, Optional[str]]]:
     - "ovqat 120000 tushlik uchun"
     - "50k taxi" (k = thousand)
     
+    Results are memoized: users retype the same short entries a lot.
+    
     Returns: (category, amount, description) or None
     """
     t = (text or "").strip()
@@ -262,9 +278,7 @@ def parse_one(text: str) -> Optional[Tuple[str, int, Optional[str]]]:
         return None
     
     # Handle "k" suffix for thousands (50k = 50000)
-    t = re.sub(r"(\d+)\s*k\b", lambda m: str(int(m.group(1)) * 1000), t, flags=re.IGNORECASE)
-    t = re.sub(r"(\d+)\s*ming\b", lambda m: str(int(m.group(1)) * 1000), t, flags=re.IGNORECASE)
-    t = re.sub(r"(\d+)\s*тыс\b", lambda m: str(int(m.group(1)) * 1000), t, flags=re.IGNORECASE)
+    t = THOUSANDS_RE.sub(lambda m: str(int(m.group(1)) * 1000), t)
     
     # Find amount
     match = AMOUNT_RE.search(t)
@@ -297,9 +311,9 @@ def parse_one(text: str) -> Optional[Tuple[str, int, Optional[str]]]:
         desc_parts += parts[1:]
     
     # If category wasn't recognized, use it as description
-    if cat not in CAT_MAP.values() and cat in CAT_MAP:
+    if cat not in CATEGORY_KEYS and cat in CAT_MAP:
         cat = CAT_MAP[cat]
-    elif cat not in CAT_MAP.values():
+    elif cat not in CATEGORY_KEYS:
         # Unknown category - treat first word as category anyway
         pass
     
@@ -317,7 +331,7 @@ def parse_multi(text: str) -> List[Tuple[str, int, Optional[str]]]:
         return []
     
     results = []
-    for part in re.split(r"[;\n]+", t):
+    for part in ENTRY_SPLIT_RE.split(t):
         part = part.strip()
         if not part:
             continue
@@ -331,14 +345,16 @@ def looks_like_expense_text(text: str) -> bool:
     """Check if text looks like an expense entry"""
     return parse_one(text) is not None
 
+# Category -> transaction type; anything not listed is an expense
+CATEGORY_TYPES = {
+    "salary": "income",
+    "business": "income",
+    "income": "income",
+    "gift": "income",
+    "debt": "debt",
+    "loan": "debt",
+}
+
 def get_type_from_category(cat: str) -> str:
     """Suggest transaction type based on category"""
-    income_cats = {"salary", "business", "income", "gift"}
-    debt_cats = {"debt", "loan"}
-    
-    normalized = normalize_category(cat)
-    if normalized in income_cats:
-        return "income"
-    elif normalized in debt_cats:
-        return "debt"
-    return "expense"
+    return CATEGORY_TYPES.get(normalize_category(cat), "expense")
@@ -10,11 +10,10 @@ import sys
 import os
 
 def main():
-    # Start API server in background
+    # Start API server in background; it inherits our stdout/stderr, since an
+    # unread PIPE fills up and then blocks the API's event loop on logging
     api_process = subprocess.Popen(
         [sys.executable, "-m", "uvicorn", "api:app", "--host", "0.0.0.0", "--port", os.getenv("PORT", "8000")],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT
     )
     print(f"🌐 API started (PID: {api_process.pid})")
     
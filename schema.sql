@@ -13,13 +13,106 @@ create table if not exists transactions (
   category_key text not null,
   description text,
   merchant text,
-  tx_date date,
+  tx_date date not null default current_date,
   source text not null default 'text',
   created_at timestamptz not null default now()
 );
 
+-- Older rows left tx_date null and every query had to coalesce it with
+-- created_at::date, which no index can serve. Backfill once and require it.
+update transactions set tx_date = created_at::date where tx_date is null;
+alter table transactions alter column tx_date set default current_date;
+alter table transactions alter column tx_date set not null;
+
 create index if not exists idx_transactions_tg_time
 on transactions (telegram_id, created_at desc);
 
 create index if not exists idx_transactions_tg_date
 on transactions (telegram_id, tx_date desc);
+
+-- Per-user daily totals, kept current by trigger so /stats/* never rescans transactions.
+create table if not exists tx_daily (
+  telegram_id bigint not null,
+  day date not null,
+  type text not null,
+  total bigint not null default 0,
+  cnt bigint not null default 0,
+  primary key (telegram_id, day, type)
+);
+
+-- Subtracts old_rows (update/delete) and adds new_rows (insert/update).
+-- Keys that drop to zero rows stay behind with total = cnt = 0, which sums the same.
+create or replace function tx_daily_apply() returns trigger
+language plpgsql as $$
+begin
+  if TG_OP in ('UPDATE', 'DELETE') then
+    update tx_daily d
+    set total = d.total - o.total, cnt = d.cnt - o.cnt
+    from (
+      select telegram_id, tx_date as day, type, sum(amount) as total, count(*) as cnt
+      from old_rows
+      group by 1, 2, 3
+    ) o
+    where d.telegram_id = o.telegram_id and d.day = o.day and d.type = o.type;
+  end if;
+  if TG_OP in ('INSERT', 'UPDATE') then
+    insert into tx_daily (telegram_id, day, type, total, cnt)
+    select telegram_id, tx_date, type, sum(amount), count(*)
+    from new_rows
+    group by 1, 2, 3
+    on conflict (telegram_id, day, type)
+    do update set total = tx_daily.total + excluded.total, cnt = tx_daily.cnt + excluded.cnt;
+  end if;
+  return null;
+end $$;
+
+create or replace function tx_daily_truncate() returns trigger
+language plpgsql as $$
+begin
+  truncate tx_daily;
+  return null;
+end $$;
+
+-- Triggers and backfill go in together, once per rollup version (kept as the
+-- table's comment): under a lock that blocks writers (not readers), so no row
+-- slips between them. Re-applying this file at the same version takes no lock
+-- and scans nothing. Bump the version when the triggers change meaning.
+do $$
+declare
+  version constant text := 'tx_daily v1';
+begin
+  if obj_description('tx_daily'::regclass, 'pg_class') is not distinct from version then
+    return;
+  end if;
+
+  lock table transactions in share row exclusive mode;
+
+  -- Transition tables allow only one event per trigger, hence one trigger each.
+  create or replace trigger trg_tx_daily_ins
+  after insert on transactions
+  referencing new table as new_rows
+  for each statement execute function tx_daily_apply();
+
+  create or replace trigger trg_tx_daily_upd
+  after update on transactions
+  referencing old table as old_rows new table as new_rows
+  for each statement execute function tx_daily_apply();
+
+  create or replace trigger trg_tx_daily_del
+  after delete on transactions
+  referencing old table as old_rows
+  for each statement execute function tx_daily_apply();
+
+  create or replace trigger trg_tx_daily_trunc
+  after truncate on transactions
+  for each statement execute function tx_daily_truncate();
+
+  -- Backfill from scratch; exact under the lock.
+  delete from tx_daily;
+  insert into tx_daily (telegram_id, day, type, total, cnt)
+  select telegram_id, tx_date, type, sum(amount), count(*)
+  from transactions
+  group by 1, 2, 3;
+
+  execute format('comment on table tx_daily is %L', version);
+end $$;